@@ -0,0 +1,458 @@
+"""Flet desktop UI for PDF Sealr: file picking, settings, live preview and batch progress."""
+from __future__ import annotations
+import base64, threading, time, logging, queue
+from collections import OrderedDict
+from dataclasses import replace
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import flet as ft
+import numpy as np
+import fitz  # PyMuPDF
+
+from flattener import (
+    EXPORT_FORMATS, RENDER_BACKENDS, BlendBuffers, FlattenOptions, WatermarkSpec,
+    apply_watermark, encode_image, has_watermark, page_pool, process_pdf, render_page, warm_jit,
+)
+
+log = logging.getLogger(__name__)
+
+# ---------------- UI Helpers ----------------
+def labeled_slider(title: str, slider: ft.Slider, unit: str = "", decimals: int = 0):
+    """Wrap a Slider with a persistent label and live value text (no popup labels)."""
+    slider.label = None  # we handle labels ourselves
+    value_text = ft.Text(f"{round(slider.value, decimals)}{unit}", width=60, text_align=ft.TextAlign.END)
+    def _on_change(e):
+        value_text.value = f"{round(slider.value, decimals)}{unit}"
+        slider.update()
+        value_text.update()
+    slider.on_change = _on_change
+    row = ft.Row([ft.Text(title), ft.Container(expand=True), value_text], alignment=ft.MainAxisAlignment.START)
+    col = ft.Column([row, slider], spacing=4)
+    return col, slider
+
+def throttled_progress(push, min_step: float = 0.01, min_interval: float = 0.1):
+    """Wrap a progress setter so page.update() only runs after >= min_step progress
+    or min_interval seconds since the last push (and always at completion)."""
+    last = {"frac": float("-inf"), "t": float("-inf")}
+    def update(frac: float):
+        now = time.monotonic()
+        if frac >= 1.0 or frac - last["frac"] >= min_step or now - last["t"] >= min_interval:
+            last["frac"], last["t"] = frac, now
+            push(frac)
+    return update
+
+# ---------------- Main UI ----------------
+PREVIEW_MAX_W = 1000  # preview raster width cap (px)
+PREVIEW_DEBOUNCE_S = 0.20  # quiet period before re-rendering the preview
+PREVIEW_BASE_CACHE_SIZE = 4  # raw page renders kept for watermark-only preview changes
+PREVIEW_CACHE_SIZE = 32  # finished previews kept, least recently shown evicted first
+PREVIEW_JPEG_QUALITY = 60  # throwaway on-screen JPEG; encode speed matters more than size
+
+class PDFToolApp(ft.Column):
+    def __init__(self, page: ft.Page):
+        super().__init__(expand=True, scroll=ft.ScrollMode.AUTO)
+        self.page = page
+        self.selected_files: List[Path] = []
+        self.output_dir = Path.home() / "PDF_Flattener_Output"
+        self.output_dir.mkdir(exist_ok=True)
+        self._preview_doc = None
+        self._preview_doc_gen = 0  # bumped on every doc swap so in-flight renders of the old doc get dropped
+        self._preview_page_index = 0
+        self._preview_cache: "OrderedDict[tuple, str]" = OrderedDict()  # (settings...) -> base64 preview jpg, LRU
+        self._preview_base_cache: Dict[Tuple[int, float], np.ndarray] = {}  # (page_index, zoom) -> raw render
+        self._preview_requests: "queue.Queue[tuple]" = queue.Queue(maxsize=1)  # latest (settings, debounce) only
+        self._preview_buffers = BlendBuffers()  # blend scratch reused across redraws of the same page size
+        self._preview_lock = threading.Lock()  # preview doc, both caches and buffers (UI thread vs preview thread)
+
+        # Start the single preview render thread (and JIT warm-up)
+        threading.Thread(target=self._preview_loop, daemon=True).start()
+        threading.Thread(target=warm_jit, daemon=True).start()
+
+        # File pickers
+        self.pick_files = ft.FilePicker(on_result=self._on_files)
+        self.pick_folder = ft.FilePicker(on_result=self._on_folder)
+        page.overlay.extend([self.pick_files, self.pick_folder])
+
+        # Queued files
+        self.files_list = ft.ListView(expand=True, height=160, spacing=6)
+        self.add_btn = ft.ElevatedButton("Add PDFs…", on_click=self._pick_files)
+        self.out_btn = ft.TextButton("Change output folder", on_click=self._pick_folder)
+        self.output_label = ft.Text(f"Output: {self.output_dir}")
+
+        # --- Controls (labels always visible)
+        self.wm_text = ft.TextField(label="Watermark text", value="CONFIDENTIAL")
+
+        self.wm_size_slider = ft.Slider(min=1, max=50, value=10, divisions=49)
+        wm_size_row, self.wm_size_slider = labeled_slider("Watermark size %", self.wm_size_slider, unit="%", decimals=0)
+
+        self.wm_opacity_slider = ft.Slider(min=30, max=255, value=120, divisions=225)
+        wm_op_row, self.wm_opacity_slider = labeled_slider("Opacity", self.wm_opacity_slider, unit="", decimals=0)
+
+        self.tile_padding_slider = ft.Slider(min=0, max=300, value=50, divisions=300)
+        tile_pad_row, self.tile_padding_slider = labeled_slider("Tile padding % (of font size)", self.tile_padding_slider, unit="%", decimals=0)
+
+        self.wm_tiled = ft.Checkbox(label="Tiled watermark", value=True, on_change=self._toggle_tile_controls)
+        self.wm_angle = ft.Checkbox(label="Rotate 45°", value=False)
+
+        self.dpi_slider = ft.Slider(min=72, max=600, value=150, divisions=528)
+        dpi_row, self.dpi_slider = labeled_slider("DPI (rendering)", self.dpi_slider, unit="", decimals=0)
+        self.smart_dpi = ft.Checkbox(label="Cap DPI at scan resolution", value=False)
+
+        self.quality_slider = ft.Slider(min=1, max=100, value=85, divisions=99)
+        quality_row, self.quality_slider = labeled_slider("JPEG quality", self.quality_slider, unit="", decimals=0)
+        self.jpeg_optimize = ft.Checkbox(label="Smaller JPEGs (slower encode)", value=False)
+
+        self.format = ft.Dropdown(
+            label="Export format",
+            options=[ft.dropdown.Option(f) for f in EXPORT_FORMATS],
+            value="pdf",
+        )
+        self.parallel = ft.Dropdown(
+            label="Parallel pages",
+            options=[ft.dropdown.Option("process"), ft.dropdown.Option("thread")],
+            value="process",
+        )
+        self.backend = ft.Dropdown(
+            label="Render backend",
+            options=[ft.dropdown.Option(b) for b in RENDER_BACKENDS],
+            value="mupdf",
+            visible=len(RENDER_BACKENDS) > 1,  # only offer a choice when pypdfium2 is installed
+        )
+
+        # Progress
+        self.file_label = ft.Text(visible=False)
+        self.file_progress = ft.ProgressBar(width=400, visible=False)
+        self.overall_label = ft.Text(visible=False)
+        self.overall_progress = ft.ProgressBar(width=400, visible=False)
+
+        # Preview
+        self.preview_image = ft.Image(width=460, height=620, fit=ft.ImageFit.CONTAIN, visible=False)
+        self.nav_controls = ft.Row([
+            ft.IconButton(ft.Icons.ARROW_BACK, on_click=self._prev_page),
+            ft.Text("Page", size=14),
+            ft.IconButton(ft.Icons.ARROW_FORWARD, on_click=self._next_page),
+        ], alignment=ft.MainAxisAlignment.CENTER)
+
+        # Buttons
+        self.process_btn = ft.FilledButton("Flatten & Export", on_click=self._process)
+        self.clear_btn = ft.TextButton("Clear", on_click=self._clear)
+
+        # Layout
+        self.controls = [
+            ft.Text("Lean PDF Flattener v4", size=20, weight=ft.FontWeight.BOLD),
+            ft.Row([self.add_btn, self.out_btn]),
+            self.output_label,
+            ft.Text("Queued files:"), self.files_list,
+            ft.Divider(),
+            ft.Text("Watermark"),
+            self.wm_text,
+            wm_size_row,
+            wm_op_row,
+            tile_pad_row,
+            ft.Row([self.wm_tiled, self.wm_angle]),
+            ft.Divider(),
+            ft.Text("Quality / Output"),
+            dpi_row,
+            self.smart_dpi,
+            quality_row,
+            self.jpeg_optimize,
+            self.format,
+            self.parallel,
+            self.backend,
+            ft.Divider(),
+            ft.Column([self.preview_image, self.nav_controls]),
+            ft.Divider(),
+            ft.Column([
+                self.file_label, self.file_progress,
+                self.overall_label, self.overall_progress,
+                ft.Row([self.process_btn, self.clear_btn])
+            ])
+        ]
+
+        # Hook preview updates (after label wrappers are created)
+        for ctrl in [self.wm_text, self.wm_size_slider, self.wm_opacity_slider,
+                     self.tile_padding_slider, self.wm_tiled, self.wm_angle,
+                     self.dpi_slider]:
+            prev = ctrl.on_change
+            def make_handler(prev_handler):
+                def handler(e):
+                    if prev_handler: prev_handler(e)
+                    self._debounced_update_preview()
+                return handler
+            ctrl.on_change = make_handler(prev)
+
+    # ---------- File handling ----------
+    def _pick_files(self, e): self.pick_files.pick_files(allow_multiple=True, allowed_extensions=["pdf"])
+    def _on_files(self, e):
+        if e.files:
+            for f in e.files:
+                path = Path(f.path)
+                if path.exists() and path not in self.selected_files:
+                    self.selected_files.append(path)
+                    self.files_list.controls.append(ft.Text(str(path)))
+            self.page.update()
+            if self.selected_files:
+                self._load_pdf_preview(self.selected_files[0])
+
+    def _pick_folder(self, e): self.pick_folder.get_directory_path()
+    def _on_folder(self, e):
+        if e.path:
+            self.output_dir = Path(e.path)
+            self.output_label.value = f"Output: {self.output_dir}"
+            self.page.update()
+
+    def _clear(self, e=None):
+        self.selected_files.clear()
+        self.files_list.controls.clear()
+        self.preview_image.visible = False
+        self._swap_preview_doc(None)
+        self.page.update()
+
+    # ---------- Processing ----------
+    def _process(self, e):
+        if not self.selected_files:
+            self._show_message("No files selected")
+            return
+        threading.Thread(target=self._worker, daemon=True).start()
+
+    def _worker(self):
+        wm = WatermarkSpec(
+            text=self.wm_text.value.strip(),
+            size_pct=float(self.wm_size_slider.value),
+            opacity=int(self.wm_opacity_slider.value),
+            tile_padding_pct=float(self.tile_padding_slider.value),
+        )
+        opts = FlattenOptions(
+            dpi=int(self.dpi_slider.value),
+            jpeg_quality=int(self.quality_slider.value),
+            export_format=self.format.value,
+            watermark=wm,
+            tiled=self.wm_tiled.value,
+            rotate_45=self.wm_angle.value,
+            backend=self.backend.value,
+            smart_dpi=self.smart_dpi.value,
+            jpeg_optimize=self.jpeg_optimize.value,
+            parallel=self.parallel.value,
+        )
+        total = len(self.selected_files)
+        self._show_progress(True)
+        overall_prog = throttled_progress(self._overall_prog)
+        # One pool for the whole batch; workers are only spawned if a file needs them
+        with page_pool() as pool:
+            for i, file in enumerate(self.selected_files, start=1):
+                self._file_label(f"Processing {file.name} ({i}/{total})")
+                file_prog = throttled_progress(self._file_prog)
+                def per_page(cur, tot): file_prog(cur / max(1, tot))
+                process_pdf(file, self.output_dir, opts, on_progress=per_page, pool=pool)
+                overall_prog(i / total)
+        self._done()
+
+    # ---------- Preview ----------
+    def _load_pdf_preview(self, path: Path):
+        try:
+            if not path.exists():
+                self._show_message(f"File not found: {path}")
+                return
+            self._swap_preview_doc(fitz.open(str(path)))
+            self._request_preview()
+        except Exception as ex:
+            self._show_message(f"Failed to load PDF: {ex}")
+
+    def _swap_preview_doc(self, doc):
+        """Replace the preview document (None to drop it) and everything cached from the old one.
+
+        Holds the preview lock so the preview thread never renders from a closed document.
+        """
+        with self._preview_lock:
+            if self._preview_doc:
+                try: self._preview_doc.close()
+                except: pass
+            self._preview_doc = doc
+            self._preview_doc_gen += 1
+            self._preview_page_index = 0
+            self._preview_cache.clear()
+            self._preview_base_cache.clear()
+
+    def _preview_settings(self) -> tuple:
+        """Snapshot of everything the preview depends on, taken on the UI thread."""
+        return (
+            self._preview_page_index,
+            self.wm_text.value or "",
+            round(self.wm_size_slider.value or 10, 3),
+            int(self.wm_opacity_slider.value or 120),
+            round(self.tile_padding_slider.value or 50, 3),
+            bool(self.wm_tiled.value),
+            bool(self.wm_angle.value),
+            int(self.dpi_slider.value or 150),
+        )
+
+    def _update_preview_image(self, e=None, settings: Optional[tuple] = None):
+        try:
+            if settings is None:
+                settings = self._preview_settings()
+            page_index, text, size_pct, opacity, padding_pct, tiled, rotate, dpi = settings
+            wm = WatermarkSpec(
+                text=text,
+                size_pct=float(size_pct),
+                opacity=opacity,
+                tile_padding_pct=float(padding_pct),
+            )
+            with self._preview_lock:
+                if not self._preview_doc:
+                    return
+                gen = self._preview_doc_gen
+                page_index = max(0, min(page_index, len(self._preview_doc) - 1))
+                zoom = self._preview_zoom(page_index, dpi)
+                cache_key = self._preview_cache_key(page_index, zoom, wm, tiled, rotate)
+                data = self._preview_cache.get(cache_key)
+                if data:
+                    self._preview_cache.move_to_end(cache_key)
+                else:
+                    base = self._render_preview_base(page_index, zoom)
+                    img = apply_watermark(base, wm, tiled=tiled, rotate=rotate, buffers=self._preview_buffers)
+                    # Encode in memory; no temp file per preview update. 4:2:0, no optimize pass
+                    jpeg = encode_image(img, "jpeg", PREVIEW_JPEG_QUALITY)
+            if not data:
+                data = base64.b64encode(jpeg).decode("ascii")
+                with self._preview_lock:
+                    if gen != self._preview_doc_gen:
+                        return  # file was replaced or cleared mid-render
+                    self._preview_cache[cache_key] = data
+                    if len(self._preview_cache) > PREVIEW_CACHE_SIZE:
+                        self._preview_cache.popitem(last=False)
+            with self._preview_lock:
+                if gen != self._preview_doc_gen:
+                    return
+                self.preview_image.src_base64 = data
+                self.preview_image.visible = True
+            self.page.update()
+        except Exception as ex:
+            log.exception("Preview failed")
+            self._show_message(f"Preview failed: {ex}")
+
+    def _preview_zoom(self, page_index: int, dpi: int) -> float:
+        """Preview render zoom: the export DPI, capped so the page is at most PREVIEW_MAX_W wide."""
+        return min(dpi / 72.0, PREVIEW_MAX_W / self._preview_doc[page_index].rect.width)
+
+    @staticmethod
+    def _preview_cache_key(page_index: int, zoom: float, wm: WatermarkSpec, tiled: bool, rotate: bool) -> tuple:
+        """Key on what actually changes the preview, so no-op changes hit the cache.
+
+        Padding only spaces tiled stamps, no watermark setting matters when there is nothing
+        to draw, and every DPI past the width cap renders at the same zoom.
+        """
+        if not has_watermark(wm):
+            return (page_index, zoom)
+        if not tiled:
+            wm = replace(wm, tile_padding_pct=0.0)
+        return (page_index, zoom, wm, bool(tiled), bool(rotate))
+
+    def _render_preview_base(self, page_index: int, zoom: float) -> np.ndarray:
+        """Page render at preview width, reused while only watermark settings change.
+
+        MuPDF rasterizes straight at the capped zoom, so no full-DPI page is allocated just to
+        be downscaled. Layout matches the export (watermark sizing is relative to page width)
+        while compositing far fewer pixels. Read-only.
+        """
+        key = (page_index, zoom)
+        base = self._preview_base_cache.get(key)
+        if base is None:
+            base = render_page(self._preview_doc, page_index, fitz.Matrix(zoom, zoom))
+            if len(self._preview_base_cache) >= PREVIEW_BASE_CACHE_SIZE:
+                # Evict the oldest render (dicts keep insertion order)
+                self._preview_base_cache.pop(next(iter(self._preview_base_cache)))
+            self._preview_base_cache[key] = base
+        return base
+
+    def _debounced_update_preview(self, e=None):
+        self._request_preview(debounce=True)
+
+    def _request_preview(self, debounce: bool = False):
+        """Queue the current settings for the preview thread, replacing any request it hasn't taken yet.
+
+        Slider and text changes debounce; page turns and newly loaded files render right away.
+        Either way only the preview thread renders, so at most one render is in flight.
+        """
+        request = (self._preview_settings(), debounce)
+        while True:
+            try:
+                self._preview_requests.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                self._preview_requests.put_nowait(request)
+                return
+            except queue.Full:
+                continue  # another handler slipped a request in between; drop it too
+
+    def _preview_loop(self):
+        """Long-lived preview thread: a burst of changes collapses into one render of the latest settings."""
+        while True:
+            settings, debounce = self._preview_requests.get()
+            # Debounce: keep taking newer settings while changes keep arriving
+            while debounce:
+                try:
+                    settings, debounce = self._preview_requests.get(timeout=PREVIEW_DEBOUNCE_S)
+                except queue.Empty:
+                    break
+            self._update_preview_image(settings=settings)
+
+    def _next_page(self, e):
+        with self._preview_lock:
+            if not (self._preview_doc and self._preview_page_index < len(self._preview_doc) - 1):
+                return
+            self._preview_page_index += 1
+        self._request_preview()
+
+    def _prev_page(self, e):
+        with self._preview_lock:
+            if not (self._preview_doc and self._preview_page_index > 0):
+                return
+            self._preview_page_index -= 1
+        self._request_preview()
+
+    def _toggle_tile_controls(self, e=None):
+        # No hidden controls here, but we can trigger a re-preview immediately
+        self._debounced_update_preview()
+
+    # ---------- Progress ----------
+    def _show_progress(self, visible):
+        self.file_label.visible = visible
+        self.file_progress.visible = visible
+        self.overall_label.visible = visible
+        self.overall_progress.visible = visible
+        self.page.update()
+
+    def _file_label(self, text):
+        self.file_label.value = text
+        self.page.update()
+
+    def _file_prog(self, f):
+        self.file_progress.value = max(0.0, min(1.0, f))
+        self.page.update()
+
+    def _overall_prog(self, f):
+        self.overall_progress.value = max(0.0, min(1.0, f))
+        self.overall_label.value = f"Overall: {int(self.overall_progress.value*100)}%"
+        self.page.update()
+
+    def _done(self):
+        self.file_label.value = "Done!"
+        self._show_message("All files processed")
+
+    def _show_message(self, text):
+        self.page.snack_bar = ft.SnackBar(ft.Text(text))
+        self.page.snack_bar.open = True
+        self.page.update()
+
+# ---------------- Entry Point ----------------
+def main(page: ft.Page):
+    page.title = "Lean PDF Flattener v4"
+    page.window_width = 1000
+    page.window_height = 820
+    page.theme_mode = ft.ThemeMode.LIGHT
+    page.padding = 16
+    page.scroll = "adaptive"
+    app = PDFToolApp(page)
+    page.add(app)
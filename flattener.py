@@ -0,0 +1,710 @@
+"""Flattening pipeline: render, watermark, encode and write pages. No UI imports.
+
+Page worker processes import this module (and re-run main.py, which stays import-free),
+so keep Flet and other UI-only dependencies out of it.
+"""
+from __future__ import annotations
+import io, os, sys, math, threading, logging, multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, Tuple
+from dataclasses import dataclass, replace
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+import fitz  # PyMuPDF
+
+try:
+    import simplejpeg  # libjpeg-turbo bindings, optional fast JPEG encoder
+except ImportError:
+    simplejpeg = None
+
+try:
+    import turbojpeg  # PyTurboJPEG, optional; needs the libturbojpeg shared library too
+    _turbo = turbojpeg.TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    turbojpeg = _turbo = None
+
+try:
+    import pyvips  # libvips bindings, optional fast PNG encoder
+except (ImportError, OSError):
+    pyvips = None
+
+try:
+    import pypdfium2 as pdfium  # optional alternative render backend
+except ImportError:
+    pdfium = None
+
+try:
+    import numba  # optional JIT for the rotated watermark stamp loop
+except ImportError:
+    numba = None
+
+try:
+    import imagecodecs  # optional, for JPEG XL export
+except ImportError:
+    imagecodecs = None
+
+RENDER_BACKENDS = ["mupdf"] + (["pdfium"] if pdfium is not None else [])
+EXPORT_FORMATS = ["pdf", "png", "jpeg"] + (["jxl"] if imagecodecs is not None and imagecodecs.JPEGXL.available else [])
+
+# ---------------- Logging ----------------
+logging.basicConfig(
+    filename="pdf_flattener.log",
+    level=logging.DEBUG,
+    format="%(asctime)s [%(levelname)s] %(message)s",
+)
+log = logging.getLogger(__name__)
+logging.getLogger("numba").setLevel(logging.WARNING)  # its compiler logs pages of DEBUG output
+
+# MuPDF prints recoverable warnings (broken xref, odd fonts) straight to stderr per page; keep
+# them in its buffer instead and log them once per document (see process_pdf)
+fitz.TOOLS.mupdf_display_errors(False)
+
+# ---------------- Utilities ----------------
+SYSTEM_SANS = [
+    "C:\\Windows\\Fonts\\segoeui.ttf",
+    "C:\\Windows\\Fonts\\arial.ttf",
+    "/System/Library/Fonts/SFNS.ttf",
+    "/System/Library/Fonts/Supplemental/Arial Unicode.ttf",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+]
+
+@lru_cache(maxsize=1)
+def find_font() -> Optional[str]:
+    """First installed font from SYSTEM_SANS; probed once, the answer doesn't change during a session."""
+    for path in SYSTEM_SANS:
+        if os.path.exists(path):
+            return path
+    return None
+
+@lru_cache(maxsize=32)
+def _load_font(path: Optional[str], size: int) -> ImageFont.ImageFont:
+    """Parsing a TrueType file is expensive; keep loaded faces per (path, size)."""
+    try:
+        return ImageFont.truetype(path, size) if path else ImageFont.load_default()
+    except Exception:
+        return ImageFont.load_default()
+
+def text_size(draw: ImageDraw.ImageDraw, text: str, font: ImageFont.FreeTypeFont) -> Tuple[int, int]:
+    # Reliable sizing with bbox
+    bbox = draw.textbbox((0, 0), text, font=font)
+    w = max(1, bbox[2] - bbox[0])
+    h = max(1, bbox[3] - bbox[1])
+    return w, h
+
+WATERMARK_RGB = (180, 180, 180)
+
+@lru_cache(maxsize=32)
+def _text_tile(text: str, font_path: Optional[str], font_px: int,
+               phase: Tuple[float, float] = (0.0, 0.0)) -> Tuple[Image.Image, Tuple[int, int]]:
+    """Rasterize the watermark text once into a tight "L" coverage tile.
+
+    Returns the tile and the bbox offset to add when pasting, so a paste at
+    (x + dx, y + dy) matches draw.text((x, y)). `phase` is the fractional part
+    (0 <= p < 1) of a non-integer x, y: the glyphs are rendered at that sub-pixel
+    offset like draw.text does, and the paste goes at (floor(x) + dx, floor(y) + dy).
+    Cached across pages and preview updates; callers must not mutate the returned tile.
+    """
+    font = _load_font(font_path, font_px)
+    left, top, right, bottom = font.getbbox(text)
+    px, py = phase
+    mx, my = max(0, -left), max(0, -top)  # keep the draw origin non-negative so int() floors it
+    canvas = Image.new("L", (mx + right + 1, my + bottom + 1), 0)
+    ImageDraw.Draw(canvas).text((mx + px, my + py), text, fill=255, font=font)
+    # A sub-pixel shift can bleed one pixel past the bbox
+    right, bottom = max(left + 1, right + (1 if px else 0)), max(top + 1, bottom + (1 if py else 0))
+    return canvas.crop((mx + left, my + top, mx + right, my + bottom)), (left, top)
+
+@dataclass(frozen=True)
+class WatermarkSpec:
+    text: str
+    size_pct: float     # relative to page width
+    opacity: int        # 0..255
+    tile_padding_pct: float  # padding between tiles, relative to font size (both axes)
+
+@dataclass
+class FlattenOptions:
+    dpi: int
+    jpeg_quality: int
+    export_format: str  # one of EXPORT_FORMATS
+    watermark: WatermarkSpec
+    tiled: bool
+    rotate_45: bool
+    png_level: int = 1  # zlib compress_level for PNG export (0..9); higher is smaller but slower
+    jpeg_optimize: bool = False  # optimized Huffman tables + progressive scans: smaller JPEGs, slower encode
+    backend: str = "mupdf"  # one of RENDER_BACKENDS
+    smart_dpi: bool = False  # cap dpi near the scan resolution for scanned documents
+    parallel: str = "process"  # process/thread: how pages are spread across cores
+
+# ---------------- PDF helpers ----------------
+def dpi_matrix(dpi: int) -> fitz.Matrix:
+    """Render matrix for a DPI; build it once per document rather than per page."""
+    zoom = max(1/4, dpi / 72)  # safe lower bound
+    return fitz.Matrix(zoom, zoom)
+
+def render_page(doc, page_index: int, mat: fitz.Matrix) -> np.ndarray:
+    """Render a page to an HxWx3 uint8 array (read-only view over the pixmap samples)."""
+    page = doc.load_page(page_index)
+    pix = page.get_pixmap(matrix=mat, colorspace=fitz.csRGB, alpha=False)
+    # Wrap the samples instead of copying them again into a PIL buffer. samples_mv would
+    # save one more copy, but it is released with the Pixmap and would leave the array dangling.
+    return np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+
+SMART_DPI_HEADROOM = 1.5  # render scans at most this far above their native resolution
+
+def scan_dpi(doc) -> Optional[float]:
+    """Native resolution of a scanned document, or None if it isn't one.
+
+    A page counts as scanned when an embedded image covers at least 90% of it; its DPI is
+    the highest of those images. Any page without such an image means vector content
+    that must render at full DPI, so the whole document is left alone.
+    """
+    best = 0.0
+    for page in doc:
+        page_area = abs(page.rect)
+        page_best = 0.0
+        for info in page.get_image_info():
+            bbox = fitz.Rect(info["bbox"])
+            if bbox.is_empty or abs(bbox & page.rect) < 0.9 * page_area:
+                continue
+            page_best = max(page_best, info["width"] * 72 / bbox.width, info["height"] * 72 / bbox.height)
+        if not page_best:
+            return None
+        best = max(best, page_best)
+    return best or None
+
+def effective_dpi(doc, dpi: int) -> int:
+    """Clamp dpi for scanned documents: pixels beyond the scan's own resolution add cost, not detail.
+
+    Applied per document (not per page) so every output page keeps the same geometry.
+    """
+    native = scan_dpi(doc)
+    if native and dpi > native * SMART_DPI_HEADROOM:
+        capped = int(round(native * SMART_DPI_HEADROOM))
+        log.info("Smart DPI: scan at %.0f dpi, rendering at %d instead of %d", native, capped, dpi)
+        return capped
+    return dpi
+
+def render_page_pdfium(pdf, page_index: int, scale: float) -> np.ndarray:
+    """pypdfium2 counterpart of render_page: HxWx3 uint8 RGB array."""
+    page = pdf[page_index]
+    bitmap = page.render(scale=scale, rev_byteorder=True)  # RGB byte order, like fitz
+    # to_numpy() views memory owned by the bitmap; copy it out before the bitmap is freed
+    arr = bitmap.to_numpy().copy()
+    bitmap.close()
+    page.close()
+    return arr
+
+STORE_SHRINK_EVERY = 16  # MuPDF pages rendered between trims of its resource store
+
+class PageRenderer:
+    """Renders pages of one document at a fixed DPI with one backend (see RENDER_BACKENDS).
+
+    MuPDF reuses `doc` when one is given and leaves closing it to the caller; otherwise
+    close() releases the document this renderer opened. MuPDF's store (decoded fonts and
+    images) is emptied every STORE_SHRINK_EVERY pages so long documents don't keep growing it.
+    """
+    def __init__(self, in_path: str, dpi: int, backend: str = "mupdf", doc=None):
+        self.backend = backend
+        if backend == "pdfium":
+            self.doc = pdfium.PdfDocument(in_path)
+            self.scale = max(1/4, dpi / 72)  # same lower bound as dpi_matrix
+            self._owns_doc = True
+        else:
+            self._owns_doc = doc is None
+            self.doc = fitz.open(in_path) if doc is None else doc
+            self.mat = dpi_matrix(dpi)
+            self._since_shrink = 0
+
+    def render(self, page_index: int) -> np.ndarray:
+        if self.backend == "pdfium":
+            return render_page_pdfium(self.doc, page_index, self.scale)
+        img = render_page(self.doc, page_index, self.mat)
+        self._page_done()
+        return img
+
+    def render_encoded(self, page_index: int, fmt: str, quality: int, png_level: int = 1,
+                       jpeg_optimize: bool = False) -> Tuple[bytes, int, int]:
+        """Render and encode a page that gets no watermark.
+
+        With MuPDF the encoder reads the pixmap's own memory through samples_mv, skipping the
+        full-page copy render() has to make. The view is dropped before the Pixmap can be freed.
+        """
+        if self.backend == "pdfium":
+            img = self.render(page_index)
+            h, w = img.shape[:2]
+            return encode_image(img, fmt, quality, png_level, jpeg_optimize), w, h
+        pix = self.doc.load_page(page_index).get_pixmap(matrix=self.mat, colorspace=fitz.csRGB, alpha=False)
+        view = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+        data = encode_image(view, fmt, quality, png_level, jpeg_optimize)
+        del view
+        self._page_done()
+        return data, pix.width, pix.height
+
+    def _page_done(self):
+        self._since_shrink += 1
+        if self._since_shrink >= STORE_SHRINK_EVERY:
+            fitz.TOOLS.store_shrink(100)
+            self._since_shrink = 0
+
+    def close(self):
+        if self._owns_doc:
+            self.doc.close()
+
+def _rotate_layer_to_canvas_size(size: Tuple[int, int], overlay: Image.Image, angle45: bool) -> Image.Image:
+    """Rotate overlay and paste it centered into a same-size empty layer so it always lines up with the page."""
+    if not angle45:
+        # Already same size, just return
+        return overlay
+    rotated = overlay.rotate(45, expand=True)
+    canvas = Image.new(overlay.mode, size, 0)
+    x = (canvas.width - rotated.width) // 2
+    y = (canvas.height - rotated.height) // 2
+    # The layer is a coverage mask: copy it as-is. Pasting it through itself would square it.
+    canvas.paste(rotated, (x, y))
+    return canvas
+
+@dataclass(frozen=True)
+class TilePlan:
+    """Blend inputs for one watermark on one page size, built once and reused for every matching page."""
+    alpha: np.ndarray              # HxW uint8, glyph coverage already scaled by opacity (read-only)
+    color: Tuple[int, int, int]
+    regions: Tuple[Tuple[int, int, int, int], ...]  # (y0, y1, x0, x1) row bands holding all non-zero alpha
+
+def _stamp_font_px(wm: WatermarkSpec, width: int) -> int:
+    """Font size independent of DPI: % of page width."""
+    return max(4, int(width * (wm.size_pct / 100.0)))
+
+def _stamp_metrics(wm: WatermarkSpec, width: int):
+    """Return (tile, (dx, dy), step_x, step_y) for the watermark at this page width."""
+    font_px = _stamp_font_px(wm, width)
+    tile, offset = _text_tile(wm.text, find_font(), font_px)
+    tw, th = tile.size
+    pad_px = int(font_px * (wm.tile_padding_pct / 100.0))
+    return tile, offset, max(1, tw + pad_px), max(1, th + pad_px)
+
+def _plan_from_mask(mask: np.ndarray, opacity: int) -> TilePlan:
+    opacity = max(0, min(255, opacity))
+    alpha = ((mask.astype(np.uint16) * opacity + 127) // 255).astype(np.uint8)
+    alpha.setflags(write=False)
+    return TilePlan(alpha=alpha, color=WATERMARK_RGB, regions=_alpha_regions(alpha))
+
+def _alpha_regions(alpha: np.ndarray) -> Tuple[Tuple[int, int, int, int], ...]:
+    """Split the mask into runs of rows with any coverage, each trimmed to its painted columns.
+
+    Unrotated tiled stamps leave blank padding between stamp rows, and a single stamp is one
+    small band, so blending just these rectangles skips most of the page.
+    """
+    painted = np.concatenate(([False], alpha.any(axis=1), [False]))
+    edges = np.flatnonzero(painted[1:] != painted[:-1])
+    regions = []
+    for y0, y1 in zip(edges[::2], edges[1::2]):
+        cols = np.flatnonzero(alpha[y0:y1].any(axis=0))
+        regions.append((int(y0), int(y1), int(cols[0]), int(cols[-1]) + 1))
+    return tuple(regions)
+
+@lru_cache(maxsize=4)
+def build_tile_plan(wm: WatermarkSpec, width: int, height: int, tiled: bool, rotate: bool) -> TilePlan:
+    """Watermark plan for a page size, tiled or single centered.
+
+    Cached on everything that shapes the overlay, so a uniform-size document builds it
+    once and every later page only pays for the blend.
+    """
+    tile, (dx, dy), step_x, step_y = _stamp_metrics(wm, width)
+    if tiled and rotate:
+        return _plan_from_mask(
+            _rotated_tiled_mask(np.asarray(tile), (dx, dy), step_x, step_y, (width, height)), wm.opacity)
+    if tiled:
+        mask = _tiled_mask(np.asarray(tile), (dx, dy), step_x, step_y, (width, height))
+    else:
+        # Single centered (can be larger than page; it's okay to crop). Half-pixel centres are
+        # rendered at that sub-pixel offset rather than snapped to a pixel.
+        tw, th = tile.size
+        x, y = (width - tw) / 2.0, (height - th) / 2.0
+        x0, y0 = math.floor(x), math.floor(y)
+        tile, (dx, dy) = _text_tile(wm.text, find_font(), _stamp_font_px(wm, width), (x - x0, y - y0))
+        mask = np.zeros((height, width), dtype=np.uint8)
+        _blit(mask, np.asarray(tile), x0 + dx, y0 + dy)
+    if rotate:
+        # Rotate watermark layer and re-center to canvas size
+        mask = np.asarray(_rotate_layer_to_canvas_size((width, height), Image.fromarray(mask), True))
+    return _plan_from_mask(mask, wm.opacity)
+
+def has_watermark(wm: WatermarkSpec) -> bool:
+    """False when the spec would leave the page untouched (blank text or zero opacity)."""
+    return bool(wm.text.strip()) and wm.opacity > 0
+
+def apply_watermark(img: np.ndarray, wm: WatermarkSpec, tiled=True, rotate=False,
+                    buffers: Optional[BlendBuffers] = None) -> np.ndarray:
+    """Draw watermark either tiled or single centered, with rotation step that preserves canvas size.
+
+    Takes and returns an HxWx3 uint8 page array; the input is returned as-is when there is nothing to draw.
+    With `buffers`, the result lives in them and is only valid until their next use.
+    """
+    if not has_watermark(wm):
+        return img
+    height, width = img.shape[:2]
+    plan = build_tile_plan(wm, width, height, bool(tiled), bool(rotate))
+    return _blend(img, plan, buffers)
+
+def _blit(dst: np.ndarray, tile: np.ndarray, x: int, y: int):
+    """Copy tile into dst with its top-left at (x, y), clipped to dst's bounds (x, y may be negative)."""
+    th, tw = tile.shape[:2]
+    x0, y0 = max(0, x), max(0, y)
+    x1, y1 = min(dst.shape[1], x + tw), min(dst.shape[0], y + th)
+    if x0 < x1 and y0 < y1:
+        dst[y0:y1, x0:x1] = tile[y0 - y:y1 - y, x0 - x:x1 - x]
+
+def _tiled_mask(tile: np.ndarray, offset: Tuple[int, int], step_x: int, step_y: int,
+                size: Tuple[int, int]) -> np.ndarray:
+    """Page-size coverage mask of staggered stamps, built with np.tile instead of a paste per stamp.
+
+    Rows are step_y apart and every other row is shifted left by half a step, so the
+    pattern repeats every (2 * step_y, step_x). One period cell is laid out with np.roll
+    (wrapping stamps that straddle the cell edge) and repeated across the page. Odd rows
+    sit at y = 0, matching the stamp grid the paste loop used to start one step above the page.
+    """
+    width, height = size
+    dx, dy = offset
+    th, tw = tile.shape
+    band = np.zeros((step_y, step_x), dtype=np.uint8)
+    band[:th, :tw] = tile  # steps are >= tile size, so a stamp always fits its band
+    cell = np.vstack([np.roll(band, dx - step_x // 2, axis=1), np.roll(band, dx, axis=1)])
+    cell = np.roll(cell, dy, axis=0)
+    reps = (-(-height // cell.shape[0]), -(-width // cell.shape[1]))
+    return np.tile(cell, reps)[:height, :width]
+
+def _rotated_tiled_mask(tile: np.ndarray, offset: Tuple[int, int], step_x: int, step_y: int,
+                        size: Tuple[int, int]) -> np.ndarray:
+    """The _tiled_mask pattern turned 45° about the page centre, without rotating a page-size layer.
+
+    The tile is rotated once and stamped at each lattice point of the rotated grid that can
+    reach the page. Stamps land where rotating the whole tiled layer put them, but the
+    pattern now also fills the page corners, which that layer left bare.
+    """
+    width, height = size
+    dx, dy = offset
+    th, tw = tile.shape
+    rotated = np.asarray(Image.fromarray(tile).rotate(45, expand=True))
+    rh, rw = rotated.shape
+    cx, cy = width / 2.0, height / 2.0
+    cos = sin = math.sqrt(0.5)
+    reach = math.hypot(width, height) / 2.0 + max(tw, th)  # stamp centres further out can't touch the page
+    xs, ys = [], []
+    for row in range(math.floor((cy - reach - dy) / step_y), math.ceil((cy + reach - dy) / step_y) + 1):
+        uy = dy + row * step_y + th / 2.0 - cy
+        shift = step_x // 2 if row % 2 == 0 else 0  # even rows sit half a step left, as in _tiled_mask
+        # Stamp centre for column c is (x0 + c*step, y0 - c*step); keep the columns whose
+        # rotated tile overlaps the page on both axes
+        x0 = cx + (dx - shift + tw / 2.0 - cx) * cos + uy * sin
+        y0 = cy - (dx - shift + tw / 2.0 - cx) * sin + uy * cos
+        step = step_x * cos
+        first = max(math.ceil((-rw / 2.0 - x0) / step), math.ceil((y0 - height - rh / 2.0) / step))
+        last = min(math.floor((width + rw / 2.0 - x0) / step), math.floor((y0 + rh / 2.0) / step))
+        for col in range(first, last + 1):
+            xs.append(int(round(x0 + col * step - rw / 2.0)))
+            ys.append(int(round(y0 - col * step - rh / 2.0)))
+    mask = np.zeros((height, width), dtype=np.uint8)
+    if _stamp_max_jit is not None:
+        _stamp_max_jit(mask, rotated, np.array(xs, dtype=np.int64), np.array(ys, dtype=np.int64))
+    else:
+        for x, y in zip(xs, ys):
+            _blit_max(mask, rotated, x, y)
+    return mask
+
+def _blit_max(dst: np.ndarray, tile: np.ndarray, x: int, y: int):
+    """Like _blit, but keeps the stronger coverage where stamps' bounding boxes overlap."""
+    th, tw = tile.shape[:2]
+    x0, y0 = max(0, x), max(0, y)
+    x1, y1 = min(dst.shape[1], x + tw), min(dst.shape[0], y + th)
+    if x0 < x1 and y0 < y1:
+        region = dst[y0:y1, x0:x1]
+        np.maximum(region, tile[y0 - y:y1 - y, x0 - x:x1 - x], out=region)
+
+def _stamp_max_kernel(dst, tile, xs, ys):
+    """_blit_max for every (xs[k], ys[k]) in one compiled loop, free of per-stamp interpreter overhead."""
+    height, width = dst.shape
+    th, tw = tile.shape
+    for k in range(xs.shape[0]):
+        x, y = xs[k], ys[k]
+        c0, c1 = max(0, -x), min(tw, width - x)
+        for r in range(max(0, -y), min(th, height - y)):
+            out, src = dst[y + r, x + c0:x + c1], tile[r, c0:c1]
+            for c in range(c1 - c0):
+                out[c] = max(out[c], src[c])  # branch-free, so LLVM vectorizes the row
+
+_stamp_max_jit = None
+if numba is not None:
+    try:
+        # Frozen (PyInstaller) builds have no source file for numba's on-disk cache to key on:
+        # cache=True raises "no locator available" there, so compile per run instead
+        _stamp_max_jit = numba.njit(cache=not getattr(sys, "frozen", False), boundscheck=False)(_stamp_max_kernel)
+    except RuntimeError:
+        log.warning("Numba JIT unavailable, stamping with _blit_max", exc_info=True)
+
+def warm_jit():
+    """Compile (or load from numba's cache) the JIT kernels up front, so the first preview doesn't stall."""
+    if _stamp_max_jit is not None:
+        _stamp_max_jit(np.zeros((8, 8), dtype=np.uint8), np.ones((4, 4), dtype=np.uint8),
+                       np.array([2], dtype=np.int64), np.array([2], dtype=np.int64))
+
+class BlendBuffers:
+    """Scratch arrays for _blend, kept while pages stay the same size so a batch doesn't
+    allocate fresh page-size arrays for every page."""
+    def __init__(self):
+        self.shape = None
+
+    def sized(self, shape: Tuple[int, int]) -> "BlendBuffers":
+        if shape != self.shape:
+            h, w = shape
+            self.work = np.empty((h, w, 3), dtype=np.uint16)
+            self.scratch = np.empty((h, w), dtype=np.uint16)
+            self.out = np.empty((h, w, 3), dtype=np.uint8)
+            self.shape = shape
+        return self
+
+def _blend(img: np.ndarray, plan: TilePlan, buffers: Optional[BlendBuffers] = None) -> np.ndarray:
+    """Blend the plan's colour into the RGB page through its alpha: (base*(255-a) + color*a) / 255.
+
+    Avoids the RGBA round trip (convert, alpha_composite, convert back) over the full page, and
+    runs in place in `buffers` (fresh ones if not given). Only the plan's regions are blended;
+    pixels outside them are copied through. The result is buffers.out, which the next blend with
+    the same buffers overwrites.
+    """
+    if not plan.regions:
+        return img
+    height, width = img.shape[:2]
+    buf = (buffers or BlendBuffers()).sized((height, width))
+    if plan.regions != ((0, height, 0, width),):
+        np.copyto(buf.out, img)
+    for region in plan.regions:
+        _blend_region(img, plan, buf, *region)
+    return buf.out
+
+def _blend_region(img: np.ndarray, plan: TilePlan, buf: BlendBuffers, y0: int, y1: int, x0: int, x1: int):
+    """Blend one rectangle of the page into buf.out, using the matching corner of buf's scratch arrays."""
+    base = img[y0:y1, x0:x1]
+    alpha = plan.alpha[y0:y1, x0:x1]
+    work = buf.work[:y1 - y0, :x1 - x0]
+    scratch = buf.scratch[:y1 - y0, :x1 - x0]
+    np.subtract(255, alpha, out=scratch, dtype=np.uint16)
+    np.multiply(base, scratch[..., None], out=work, dtype=np.uint16)
+    for c, value in enumerate(plan.color):
+        np.multiply(alpha, value, out=scratch, dtype=np.uint16)
+        scratch += 127  # round to nearest in the divide below
+        work[..., c] += scratch
+    np.floor_divide(work, 255, out=work)
+    np.copyto(buf.out[y0:y1, x0:x1], work, casting="unsafe")
+
+def encode_image(img: np.ndarray, fmt: str, quality: int, png_level: int = 1,
+                 jpeg_optimize: bool = False) -> bytes:
+    """Encode an HxWx3 uint8 page array as JPEG, PNG or JPEG XL bytes.
+
+    jpeg_optimize trades encode time for size: Pillow computes optimal Huffman tables and
+    writes progressive scans, often a good deal smaller at the same quality.
+    JPEG XL losslessly repacks the JPEG encode (roughly 20-40% smaller, and it can be turned
+    back into the identical JPEG).
+    """
+    buf = io.BytesIO()
+    if fmt.lower() == "jxl":
+        return imagecodecs.jpegxl_encode_jpeg(encode_image(img, "jpeg", quality, png_level, jpeg_optimize))
+    if fmt.lower() == "jpeg":
+        quality = max(1, min(100, quality))
+        if jpeg_optimize:
+            Image.fromarray(img).save(buf, format="JPEG", quality=quality, subsampling=2,
+                                      optimize=True, progressive=True)
+        elif simplejpeg is not None:
+            # 4:2:0 matches Pillow's default subsampling; fast DCT only below near-lossless quality
+            return simplejpeg.encode_jpeg(np.ascontiguousarray(img), quality=quality, colorspace="RGB",
+                                          colorsubsampling="420", fastdct=quality < 95)
+        elif _turbo is not None:
+            # Same settings through a system libjpeg-turbo (PyTurboJPEG defaults to BGR input)
+            return _turbo.encode(np.ascontiguousarray(img), quality=quality, pixel_format=turbojpeg.TJPF_RGB,
+                                 jpeg_subsample=turbojpeg.TJSAMP_420,
+                                 flags=turbojpeg.TJFLAG_FASTDCT if quality < 95 else 0)
+        else:
+            Image.fromarray(img).save(buf, format="JPEG", quality=quality)
+    elif pyvips is not None:
+        # libvips' PNG writer is roughly 5-10x faster than Pillow's at the same zlib level
+        img = np.ascontiguousarray(img)
+        h, w, bands = img.shape
+        return pyvips.Image.new_from_memory(img.data, w, h, bands, "uchar").pngsave_buffer(
+            compression=max(0, min(9, png_level)))
+    else:
+        # optimize=True retries several zlib strategies; a fixed low level is far faster
+        Image.fromarray(img).save(buf, format="PNG", compress_level=max(0, min(9, png_level)))
+    return buf.getvalue()
+
+def save_pdf(pages: Iterable[Tuple[bytes, int, int]], out_path: Path):
+    """Write pre-encoded (jpeg_bytes, width, height) pages into a new PDF as they arrive."""
+    pdf = fitz.open()
+    for data, w, h in pages:
+        rect = fitz.Rect(0, 0, w, h)
+        page = pdf.new_page(width=w, height=h)
+        page.insert_image(rect, stream=data)
+    pdf.save(out_path)
+    pdf.close()
+
+# ---------------- Page workers ----------------
+POOL_MIN_PAGES = 4  # below this, worker start-up costs more than it saves
+# Rendered megapixels a document needs before worker processes pay off. Each spawned worker
+# takes ~0.3-0.5 s to start (interpreter + PyMuPDF/NumPy/Pillow imports) while pages run at
+# roughly 10-15 ms per megapixel inline, so smaller jobs use the thread path instead.
+POOL_MIN_MEGAPIXELS = 100
+
+_worker_source = None  # ((in_path, dpi, backend), PageRenderer) held by this worker process
+
+def _worker_renderer(in_path: str, dpi: int, backend: str) -> PageRenderer:
+    """This worker process's renderer. Documents can't be shared across processes, so each
+    worker opens the source itself, once per file rather than once per page."""
+    global _worker_source
+    key = (in_path, dpi, backend)
+    if _worker_source is None or _worker_source[0] != key:
+        if _worker_source is not None:
+            _worker_source[1].close()
+        _worker_source = (key, PageRenderer(in_path, dpi, backend))
+    return _worker_source[1]
+
+def _output_format(opts: FlattenOptions) -> str:
+    """Page encoding for the export; PDF export embeds JPEG pages."""
+    return "jpeg" if opts.export_format == "pdf" else opts.export_format
+
+def _render_encode_page(renderer: PageRenderer, page_index: int, opts: FlattenOptions) -> Tuple[bytes, int, int]:
+    """Render, watermark and encode one page."""
+    if not has_watermark(opts.watermark):
+        return renderer.render_encoded(page_index, _output_format(opts), opts.jpeg_quality, opts.png_level,
+                                       opts.jpeg_optimize)
+    return _finish_page(renderer.render(page_index), opts)
+
+_thread_state = threading.local()
+
+def _finish_page(img: np.ndarray, opts: FlattenOptions) -> Tuple[bytes, int, int]:
+    """Watermark and encode a rendered page, reusing this thread's blend buffers."""
+    buffers = getattr(_thread_state, "blend_buffers", None)
+    if buffers is None:
+        buffers = _thread_state.blend_buffers = BlendBuffers()
+    img = apply_watermark(
+        img,
+        opts.watermark,
+        tiled=opts.tiled,
+        rotate=opts.rotate_45,
+        buffers=buffers,
+    )
+    data = encode_image(img, _output_format(opts), opts.jpeg_quality, opts.png_level, opts.jpeg_optimize)
+    h, w = img.shape[:2]
+    return data, w, h
+
+def _pool_page_job(in_path: str, page_index: int, opts: FlattenOptions) -> Tuple[bytes, int, int]:
+    try:
+        return _render_encode_page(_worker_renderer(in_path, opts.dpi, opts.backend), page_index, opts)
+    finally:
+        # Each worker has its own MuPDF warning buffer; drain it per page so nothing piles up
+        warnings = fitz.TOOLS.mupdf_warnings()
+        if warnings:
+            log.warning("MuPDF warnings for %s page %d:\n%s", in_path, page_index + 1, warnings)
+
+def page_pool(workers: Optional[int] = None) -> ProcessPoolExecutor:
+    """Process pool for page work. Share one across a batch so workers are spawned only once."""
+    # spawn: forking a process that already runs UI threads is not safe
+    return ProcessPoolExecutor(
+        max_workers=workers or os.cpu_count() or 1,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+
+def render_megapixels(doc, dpi: int) -> float:
+    """Size of the whole document rendered at dpi, from the page boxes (no pages are loaded)."""
+    area_pt = sum(r.width * r.height for r in map(doc.page_cropbox, range(doc.page_count)))
+    return area_pt * (dpi / 72.0) ** 2 / 1e6
+
+def _iter_pages(doc, in_path: Path, opts: FlattenOptions, pool: Optional[ProcessPoolExecutor] = None):
+    """Yield encoded pages in order, fanning out across cores for longer documents.
+
+    Process mode only starts workers for jobs of at least POOL_MIN_MEGAPIXELS; smaller ones
+    run on threads, which start for free.
+    """
+    total = doc.page_count
+    workers = min(os.cpu_count() or 1, total)
+    if workers <= 1 or total < POOL_MIN_PAGES:
+        yield from _iter_pages_inline(doc, in_path, opts, workers=1)
+    elif opts.parallel == "thread" or render_megapixels(doc, opts.dpi) < POOL_MIN_MEGAPIXELS:
+        yield from _iter_pages_inline(doc, in_path, opts, workers=min(8, workers))
+    else:
+        yield from _iter_pages_pool(in_path, total, opts, workers, pool)
+
+def _iter_pages_inline(doc, in_path: Path, opts: FlattenOptions, workers: int):
+    """Render on this thread; with workers > 1, watermark + encode earlier pages on a thread pool.
+
+    PyMuPDF must not be driven from several threads at once, so rendering stays here. The
+    NumPy blend and the JPEG/PNG encoders release the GIL, so they overlap with the next
+    render without process start-up or pickling costs (useful where spawn is slow, e.g. Windows).
+    """
+    renderer = PageRenderer(str(in_path), opts.dpi, opts.backend, doc)
+    try:
+        if workers <= 1:
+            for i in range(doc.page_count):
+                yield _render_encode_page(renderer, i, opts)
+            return
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = deque()
+            for i in range(doc.page_count):
+                pending.append(pool.submit(_finish_page, renderer.render(i), opts))
+                if len(pending) > workers:  # bound rendered pages held in memory
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+    finally:
+        renderer.close()
+
+def _iter_pages_pool(in_path: Path, total: int, opts: FlattenOptions, workers: int,
+                     pool: Optional[ProcessPoolExecutor] = None):
+    """Render, watermark and encode in worker processes, yielding results in page order.
+
+    Uses `pool` when given (kept alive across a batch), otherwise a pool just for this file.
+    """
+    if pool is None:
+        with page_pool(workers) as own_pool:
+            yield from _iter_pages_pool(in_path, total, opts, workers, own_pool)
+        return
+    yield from pool.map(_pool_page_job, repeat(str(in_path)), range(total), repeat(opts))
+
+def _with_progress(pages: Iterable[Tuple[bytes, int, int]], total: int, on_progress=None) -> Iterator[Tuple[bytes, int, int]]:
+    """Pass pages through, reporting each one once the consumer has written it."""
+    for i, page in enumerate(pages):
+        yield page
+        if on_progress:
+            on_progress(i + 1, total)
+
+def process_pdf(in_path: Path, out_dir: Path, opts: FlattenOptions, on_progress=None,
+                pool: Optional[ProcessPoolExecutor] = None):
+    """Flatten one PDF, streaming each page to the output as soon as it is encoded.
+
+    Only encoded bytes for the pages in flight are held, never the whole document's rasters.
+    Pass a page_pool() to reuse worker processes across several files.
+    """
+    outputs = []
+    stem = in_path.stem
+    fitz.TOOLS.reset_mupdf_warnings()  # drop anything the preview left, so it isn't logged under this file
+    with fitz.open(in_path) as doc:
+        if opts.smart_dpi:
+            opts = replace(opts, dpi=effective_dpi(doc, opts.dpi))
+        pages = _with_progress(_iter_pages(doc, in_path, opts, pool), doc.page_count, on_progress)
+        if opts.export_format == "pdf":
+            out = out_dir / f"{stem}_flattened.pdf"
+            save_pdf(pages, out)
+            outputs.append(out)
+        else:
+            for idx, (data, _, _) in enumerate(pages, start=1):
+                out = out_dir / f"{stem}_{idx:03d}.{opts.export_format}"
+                with open(out, "wb") as f:
+                    f.write(data)
+                outputs.append(out)
+    # Drop this document's decoded fonts/images from MuPDF's store before the next file
+    fitz.TOOLS.store_shrink(100)
+    warnings = fitz.TOOLS.mupdf_warnings()
+    if warnings:
+        log.warning("MuPDF warnings for %s:\n%s", in_path, warnings)
+    return outputs